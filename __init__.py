@@ -51,13 +51,15 @@ class Agent(object):
     def update_MC(self):
         #compute monte carlo return
         returns_ = torch.Tensor(discount_rwds(np.asarray(self.saved_rewards), gamma=self.gamma)) # compute returns
-        for (log_prob, value), r in zip(self.saved_actions, returns_):
+        policy_losses = [None]*len(returns_)
+        value_losses = [None]*len(returns_)
+        for i, ((log_prob, value), r) in enumerate(zip(self.saved_actions, returns_)):
             rpe = r - value.item()
-            policy_losses.append(-log_prob * rpe)
+            policy_losses[i] = -log_prob * rpe
             return_bs = Variable(torch.Tensor([[r]])).unsqueeze(-1) # used to make the shape work out
-            value_losses.append(F.smooth_l1_loss(value, return_bs))
+            value_losses[i] = F.smooth_l1_loss(value, return_bs)
         self.optimizer.zero_grad()
-        p_loss, v_loss = torch.cat(policy_losses).sum(), torch.cat(value_losses).sum()
+        p_loss, v_loss = torch.stack(policy_losses).sum(), torch.stack(value_losses).sum()
         total_loss = p_loss + v_loss
         total_loss.backward(retain_graph=False)
         self.optimizer.step()
@@ -4,13 +4,20 @@ import torch
 import matplotlib.pyplot as plt
 
 def get_action(agent, s):
-    action, logprob, value = agent.get_action(s)
+    # only the action is used; without a graph the reused obs_buf isn't saved for backward
+    # (pass obs_buf.clone() instead if logprob / value are ever kept for training)
+    with torch.no_grad():
+        action, logprob, value = agent.get_action(s)
     return action
 
 def agent_test(env, agent):
     maxsteps = 100
+    # allocate the (1, *obs_shape) input once and copy each new observation into it
+    obs_buf = torch.empty((1,) + np.shape(env.get_observation()), dtype=torch.float32,
+                          pin_memory=torch.cuda.is_available())
     for step in range(maxsteps):
-        s = torch.Tensor(np.expand_dims(env.get_observation(), axis=0))
+        np.copyto(obs_buf.numpy()[0], env.get_observation(), casting='same_kind')
+        s = obs_buf
 
         action = get_action(agent, s)
 
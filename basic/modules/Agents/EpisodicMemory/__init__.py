@@ -106,6 +106,37 @@ class EpisodicMemory(object):
 				policy = softmax( similarity*deltas, T=mem_temp)
 			return policy
 
+	def recall_mem_batch(self, keys, timestep=0, **kwargs):
+		'''
+		same as recall_mem for a set of keys at once
+
+		returns one policy per key as the rows of an array
+		'''
+		mem_temp = kwargs.get('mem_temp', self.mem_temp)
+		envelope = kwargs.get('pval_decay_env', self.memory_envelope)
+
+		if len(self.cache_list) == 0:
+			random_policy = softmax(np.zeros(self.n_actions))
+			return np.tile(random_policy, (len(keys), 1))
+		elif self.similarity_measure != self.key_sim:
+			return np.stack([self.recall_mem(tuple(k), timestep=timestep, **kwargs) for k in keys])
+		else:
+			entries   = np.asarray(keys)
+			mem_cache = np.asarray(list(self.cache_list.keys()))
+			# closest stored key for every entry, as in key_sim; squared distances avoid an (entries x keys x dims) array
+			sq_dist = (entries**2).sum(axis=1)[:,None] + (mem_cache**2).sum(axis=1)[None,:] - 2*np.dot(entries, mem_cache.T)
+			closest = np.argmin(sq_dist, axis=1)
+
+			memory = np.nan_to_num(np.stack([x[0] for x in self.cache_list.values()]))[closest]
+			deltas = memory[:,:,0]
+			if self.use_pvals:
+				times = abs(timestep - memory[:,:,1])
+				pvals = self.make_pvals(times, envelope=envelope)
+				policy = softmax(np.multiply(deltas,pvals), T=mem_temp, axis=1)
+			else:
+				policy = softmax(deltas, T=mem_temp, axis=1)
+			return policy
+
 	def make_pvals(self, p, **kwargs):
 		if isinstance(p,int):
 			ratio = p/self.memory_envelope
@@ -1,5 +1,5 @@
 import gym
-from .annik_ac import ActorCritic
+from .annik_ac import ActorCritic, fuse_bn_into_conv
 
 from .cnn import CNN_AC
 from .cnn_2n import CNN_2N
@@ -6,11 +6,34 @@
 #           IMPORT MODULES            #
 # =====================================
 from __future__ import division, print_function
-import numpy as np
+import functools
+import operator
 
 import torch
 import torch.nn.functional as F
-from torch.autograd import Variable
+
+
+@functools.lru_cache(maxsize=None)
+def conv_output_size(size_in, padding, dilation, kernel_size, stride):
+    # output size along one spatial dimension for conv / pool layers, in plain python ints
+    return (size_in + 2 * padding - dilation * (kernel_size - 1) - 1) // stride + 1
+
+
+def fuse_bn_into_conv(conv, bn):
+    # fold an eval-mode batchnorm into the conv that precedes it so both run as one conv:
+    #   W_hat = gamma/sqrt(var+eps) * W
+    #   b_hat = gamma*(b-mu)/sqrt(var+eps) + beta
+    # the bn module can be dropped from the forward pass afterwards
+    with torch.no_grad():
+        gamma = bn.weight if bn.affine else torch.ones_like(bn.running_var)
+        beta = bn.bias if bn.affine else torch.zeros_like(bn.running_mean)
+        bias = conv.bias if conv.bias is not None else torch.zeros_like(bn.running_mean)
+
+        scale = gamma / torch.sqrt(bn.running_var + bn.eps)
+        conv.weight.copy_(conv.weight * scale[:, None, None, None])
+        b_hat = (bias - bn.running_mean) * scale + beta
+    conv.bias = torch.nn.Parameter(b_hat)
+    return conv
 
 
 class ActorCritic(torch.nn.Module):
@@ -57,6 +80,16 @@ class ActorCritic(torch.nn.Module):
         else:
             self.temperature = agent_params.temp
 
+        if 'use_torch_compile' not in params_dict.keys():
+            self.use_torch_compile = kwargs.get('use_torch_compile', False)
+        else:
+            self.use_torch_compile = agent_params.use_torch_compile
+
+        if 'allow_bf16' not in params_dict.keys():
+            self.allow_bf16 = kwargs.get('allow_bf16', False)
+        else:
+            self.allow_bf16 = agent_params.allow_bf16
+
         if 'hidden_types' in params_dict.keys():
             if len(agent_params.hidden_dims) != len(agent_params.hidden_types):
                 raise Exception('Incorrect specification of hidden layer dimensions')
@@ -66,20 +99,23 @@ class ActorCritic(torch.nn.Module):
             self.hidden = torch.nn.ModuleList()
             self.hidden_dims = agent_params.hidden_dims
 
-            self.hx = []
-            self.cx = []
+            # record which layers need their input flattened so forward doesn't re-check layer types
+            self._flatten_before = []
             # calculate dimensions for each layer
             for ind, htype in enumerate(self.hidden_types):
                 if htype not in ['linear', 'lstm', 'gru', 'conv', 'pool']:
                     raise Exception(f'Unrecognized type for hidden layer {ind}')
                 if ind == 0:
                     input_d = self.input_dims
+                    flatten = False
                 else:
-                    if self.hidden_types[ind - 1] in ['conv', 'pool'] and not htype in ['conv', 'pool']:
-                        input_d = int(np.prod(self.hidden_dims[ind - 1]))
+                    flatten = self.hidden_types[ind - 1] in ['conv', 'pool'] and not htype in ['conv', 'pool']
+                    if flatten:
+                        input_d = functools.reduce(operator.mul, self.hidden_dims[ind - 1], 1)
 
                     else:
                         input_d = self.hidden_dims[ind - 1]
+                self._flatten_before.append(flatten)
 
                 if htype in ['conv', 'pool']:
                     output_d = tuple(self.conv_output(input_d))
@@ -92,30 +128,20 @@ class ActorCritic(torch.nn.Module):
                 if htype == 'linear':
                     self.hidden.append(torch.nn.Linear(input_d, output_d))
                     torch.nn.init.xavier_normal_(self.hidden[-1].weight)
-                    self.hx.append(None)
-                    self.cx.append(None)
                 elif htype == 'lstm':
                     self.hidden.append(torch.nn.LSTMCell(input_d, output_d))
-                    self.hx.append(Variable(torch.zeros(self.batch_size, output_d)))
-                    self.cx.append(Variable(torch.zeros(self.batch_size, output_d)))
                 elif htype == 'gru':
                     self.hidden.append(torch.nn.GRUCell(input_d, output_d))
-                    self.hx.append(Variable(torch.zeros(self.batch_size, output_d)))
-                    self.cx.append(None)
                 elif htype == 'conv':
                     in_channels = input_d[0]
                     out_channels = output_d[0]
                     self.hidden.append(
                         torch.nn.Conv2d(in_channels, out_channels, kernel_size=self.rfsize, padding=self.padding,
                                         stride=self.stride, dilation=self.dilation))
-                    self.hx.append(None)
-                    self.cx.append(None)
                 elif htype == 'pool':
                     self.hidden.append(
                         torch.nn.MaxPool2d(kernel_size=self.rfsize, padding=self.padding, stride=self.stride,
                                            dilation=self.dilation))
-                    self.hx.append(None)
-                    self.cx.append(None)
 
             # create the actor and critic layers
             self.layers = [self.input_dims] + self.hidden_dims + [self.action_dims]
@@ -132,9 +158,37 @@ class ActorCritic(torch.nn.Module):
 
         self.optimizer = torch.optim.Adam(self.parameters(), lr=self.lr)
 
-        self.device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu:0')
+        self.device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
         self.to(self.device)
 
+        # .to() doesn't move tensors held in plain lists, so the zero states are built on the device here,
+        # and kept so reinit_hid doesn't allocate new ones every trial
+        self._hx_buf, self._cx_buf = self._zero_states(device=self.device)
+        self.hx = list(self._hx_buf)
+        self.cx = list(self._cx_buf)
+
+        if self.allow_bf16 and self.device.type == 'cuda':
+            # let fp32 matmuls / convs use tensor cores on Ampere+
+            torch.backends.cuda.matmul.allow_tf32 = True
+            torch.backends.cudnn.allow_tf32 = True
+
+        # compile forward pass used for every action selection; needs torch >= 2.2 for Module.compile
+        if self.use_torch_compile:
+            if not hasattr(self, 'compile'):
+                raise Exception(f'use_torch_compile requires torch >= 2.2, found {torch.__version__}')
+            self.compile(mode='reduce-overhead', fullgraph=False)
+
+    def __setstate__(self, state):
+        # networks pickled with torch.save before these attributes existed are missing them on load
+        super().__setstate__(state)
+        if not hasattr(self, '_flatten_before'):
+            self._flatten_before = [i > 0 and self.hidden_types[i-1] in ['conv', 'pool']
+                                    and htype not in ['conv', 'pool']
+                                    for i, htype in enumerate(self.hidden_types)]
+        if getattr(self, 'device', None) == torch.device('cpu:0'):
+            # tensors report plain 'cpu', which compiled graphs treat as a different device
+            self.device = torch.device('cpu')
+
     def conv_output(self, input_tuple, **kwargs):
         channels, h_in, w_in = input_tuple
         padding = kwargs.get('padding', self.padding)
@@ -142,69 +196,96 @@ class ActorCritic(torch.nn.Module):
         kernel_size = kwargs.get('rfsize', self.rfsize)
         stride = kwargs.get('stride', self.stride)
 
-        h_out = int(np.floor(((h_in + 2 * padding - dilation * (kernel_size - 1) - 1) / stride) + 1))
-        w_out = int(np.floor(((w_in + 2 * padding - dilation * (kernel_size - 1) - 1) / stride) + 1))
+        h_out = conv_output_size(int(h_in), padding, dilation, kernel_size, stride)
+        w_out = conv_output_size(int(w_in), padding, dilation, kernel_size, stride)
 
-        return (channels, h_out, w_out)
+        return (int(channels), h_out, w_out)
 
-    def forward(self, x):
-        x = torch.Tensor(x) ### add cuda here if you want GPU
+    def forward(self, x, log_policy=False):
+        # no copy if x is already a float tensor on the network's device
+        x = torch.as_tensor(x, dtype=torch.float32, device=self.device)
         # check the inputs
         if type(self.input_dims) == int:
             assert x.shape[-1] == self.input_dims
         elif type(self.input_dims) == tuple:
             if x.shape[0] == 1:
                 assert self.input_dims == tuple(x.shape[1:])  # x.shape[0] is the number of items in the batch
-            if not (isinstance(self.hidden[0], torch.nn.Conv2d) or isinstance(self.hidden[0], torch.nn.MaxPool2d)):
+            if self.hidden_types[0] not in ['conv', 'pool']:
                 raise Exception(f'image to non {self.hidden[0]} layer')
 
+        # layer outputs are fresh tensors, so outside of training the activation can overwrite them
+        inplace = not self.training
+
         # pass the data through each hidden layer
         for i, layer in enumerate(self.hidden):
+            htype = self.hidden_types[i]
             # squeeze if last layer was conv/pool and this isn't
-            if i > 0:
-                if (isinstance(self.hidden[i - 1], torch.nn.Conv2d) or isinstance(self.hidden[i - 1],
-                                                                                  torch.nn.MaxPool2d)) and \
-                        not (isinstance(layer, torch.nn.Conv2d) or isinstance(layer, torch.nn.MaxPool2d)):
-                    x = x.view(x.shape[0], -1)
+            if self._flatten_before[i]:
+                x = x.view(x.shape[0], -1)
 
             # run input through the layer depending on type
-            if isinstance(layer, torch.nn.Linear):
-                x = F.relu(layer(x))
-            elif isinstance(layer, torch.nn.LSTMCell):
+            if htype == 'linear':
+                if inplace:
+                    x = F.relu_(layer(x))
+                else:
+                    x = F.relu(layer(x))
+            elif htype == 'lstm':
+                # cell outputs are new tensors and nothing here modifies them in place, so they're stored without a copy
                 x, cx = layer(x, (self.hx[i], self.cx[i]))
-                self.hx[i] = x.clone()
-                self.cx[i] = cx.clone()
-            elif isinstance(layer, torch.nn.GRUCell):
+                self.hx[i] = x
+                self.cx[i] = cx
+            elif htype == 'gru':
                 x = layer(x, self.hx[i])
-                self.hx[i] = x.clone()
-            elif isinstance(layer, torch.nn.Conv2d):
-                x = F.relu(layer(x))
+                self.hx[i] = x
+            elif htype == 'conv':
+                if inplace:
+                    x = F.relu_(layer(x))
+                else:
+                    x = F.relu(layer(x))
                 self.conv = x
-            elif isinstance(layer, torch.nn.MaxPool2d):
+            elif htype == 'pool':
                 x = layer(x)
 
         self.h_act = x
         # pass to the output layers
-        policy = F.softmax(self.output[0](x)/self.temperature, dim=-1)
+        # log_policy=True returns log probabilities so action selection can sample in logit space
+        if log_policy:
+            policy = F.log_softmax(self.output[0](x)/self.temperature, dim=-1)
+        else:
+            policy = F.softmax(self.output[0](x)/self.temperature, dim=-1)
         value = self.output[1](x)
 
         return policy, value
 
+    def autocast(self):
+        # reduced precision context for action selection and snapshots when allow_bf16 is set
+        # outputs should be cast back with .float() before computing losses
+        return torch.autocast(device_type=self.device.type, dtype=torch.bfloat16,
+                              enabled=getattr(self, 'allow_bf16', False))
+
+    def fuse_for_inference(self):
+        # in eval mode forward applies relu in place on the conv / linear outputs, so conv + relu is one write
+        # conv bias is already applied inside the conv kernel; when batchnorm layers are added after
+        # convs they should be folded into the conv weights here with fuse_bn_into_conv
+        self.eval()
+        return self
+
+    def _zero_states(self, device=None):
+        # zero hidden states for the lstm / gru layers (and cell states for lstm), None for the other layers
+        hx = [torch.zeros(self.batch_size, layer.hidden_size, device=device) if htype in ['lstm', 'gru'] else None
+              for htype, layer in zip(self.hidden_types, self.hidden)]
+        cx = [torch.zeros(self.batch_size, layer.hidden_size, device=device) if htype == 'lstm' else None
+              for htype, layer in zip(self.hidden_types, self.hidden)]
+        return hx, cx
+
     def reinit_hid(self):
-        # to store a record of the last hidden states
-        self.hx = []
-        self.cx = []
+        # reset to zero hidden states. forward reassigns hx/cx rather than writing into them,
+        # so the preallocated zero tensors can be handed back directly
+        # rebuild them if missing (networks pickled before they existed), or if the batch size / device changed
+        if not hasattr(self, '_hx_buf') or any(h is not None and (h.shape[0] != self.batch_size or h.device != self.device)
+                                               for h in self._hx_buf):
+            self._hx_buf, self._cx_buf = self._zero_states(device=self.device)
 
-        for i, layer in enumerate(self.hidden):
-            if isinstance(layer, torch.nn.Linear):
-                pass
-            elif isinstance(layer, torch.nn.LSTMCell):
-                self.hx.append(Variable(torch.zeros(self.batch_size, layer.hidden_size)))
-                self.cx.append(Variable(torch.zeros(self.batch_size, layer.hidden_size)))
-            elif isinstance(layer, torch.nn.GRUCell):
-                self.hx.append(Variable(torch.zeros(self.batch_size, layer.hidden_size)))
-                self.cx.append(None)
-            elif isinstance(layer, torch.nn.Conv2d):
-                pass
-            elif isinstance(layer, torch.nn.MaxPool2d):
-                pass
+        # to store a record of the last hidden states
+        self.hx = list(self._hx_buf)
+        self.cx = list(self._cx_buf)
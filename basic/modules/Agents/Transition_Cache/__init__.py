@@ -7,20 +7,29 @@
 # clear_transitions = used to setup numpy arrays to store transition data
 # get_transitions = returns numpy arrays of all transitions currently saved
 # sample_transitions = returns a sample of transitions currently saved in transition Cache
+# get_rewards = returns numpy array of rewards for the transitions currently saved
 # save_transitions = TO DO
 
 import random
+import numpy as np
 
 class Transition_Cache():
     def __init__(self, cache_size):
         self.cache_size = cache_size
         self.transition_cache = []
         self.cache_cntr = 0
+        # rewards are also kept in a preallocated array so returns can be computed without
+        # walking the list of transitions
+        self.rewards = np.zeros(cache_size, dtype=np.float32)
+        # number of transitions already used for an n-step update; reset with the cache
+        self.n_updated = 0
 
     def store_transition(self, transition):
         if len(self.transition_cache) < self.cache_size:
+            self.rewards[len(self.transition_cache)] = transition.reward
             self.transition_cache.append(transition)
         else:
+            self.rewards[self.cache_cntr] = transition.reward
             self.transition_cache[self.cache_cntr] = transition
             self.cache_cntr += 1 if self.cache_cntr < self.cache_size else 0
 
@@ -28,6 +37,10 @@ class Transition_Cache():
     def clear_cache(self):
         self.transition_cache = []
         self.cache_cntr = 0
+        self.n_updated = 0
+
+    def get_rewards(self):
+        return self.rewards[:len(self.transition_cache)]
 
     # samples transitions - can be used for TD methods that require buffer
     def sample_transition_cache(self, batch_size):
@@ -9,9 +9,9 @@ import numpy as np
 from collections import namedtuple
 import torch
 import torch.nn.functional as F
-from torch.distributions import Categorical
 
 from .Transition_Cache import Transition_Cache
+from ..Utils import discount_rwds
 
 
 Transition = namedtuple('Transition', 'episode, transition, state, action, reward, \
@@ -36,26 +36,35 @@ class Agent(object):
         else:
             self.calc_loss = self.MC_loss
 
-    def MF_action(self, state_observation):
-        policy, value = self.MFC(state_observation)
+        # if set, update every n events with bootstrapped returns instead of once at the end of the trial
+        self.update_every_n = kwargs.get('update_every_n', None)
+        self.nstep_loss = [0.0, 0.0] # summed over the n-step updates of the current trial
 
-        a = Categorical(probs=policy,logits=None)
+    def MF_action(self, state_observation):
+        with self.MFC.autocast():
+            log_policy, value = self.MFC(state_observation, log_policy=True)
+        log_policy, value = log_policy.float(), value.float()
 
-        action = a.sample()
-        return action.item(), a.log_prob(action), value.view(-1) ##TODO: why view instead of item
+        # sample directly rather than building a Categorical distribution every step
+        # gumbel-max trick: argmax(log p - log(-log U)) is distributed as p
+        u = torch.rand_like(log_policy)
+        action = (log_policy - (-u.log()).log()).argmax(-1, keepdim=True)
+        log_prob = log_policy.gather(-1, action).squeeze()
+        return action.item(), log_prob, value.view(-1) ##TODO: why view instead of item
 
     def EC_action(self, state_observation):
-        MF_policy, value = self.MFC(state_observation)
+        with self.MFC.autocast():
+            MF_log_policy, value = self.MFC(state_observation, log_policy=True)
+        MF_log_policy, value = MF_log_policy.float(), value.float()
 
         #mem_state = self.memory_query(state_observation)
         mem_state = tuple(state_observation)
-        EC_policy = torch.Tensor(self.EC.recall_mem(mem_state, timestep=self.counter))
-
-        a = Categorical(probs=EC_policy,logits=None)
-        b = Categorical(probs=MF_policy,logits=None)
+        EC_policy = torch.as_tensor(self.EC.recall_mem(mem_state, timestep=self.counter), dtype=torch.float32, device=value.device)
 
-        action = a.sample() # select action using episodic
-        return action.item(), b.log_prob(action), value.view(-1)
+        action = torch.multinomial(EC_policy, 1) # select action using episodic
+        # match the MF policy's batch dims so gather works for both (n_actions,) and (1, n_actions)
+        log_prob = MF_log_policy.gather(-1, action.view(*MF_log_policy.shape[:-1], 1)).squeeze()
+        return action.item(), log_prob, value.view(-1)
 
     def EC_storage(self):
         mem_dict = {}
@@ -81,20 +90,17 @@ class Agent(object):
     def MC_loss(self):
         # compute monte carlo return
         self.discount_rwds()
+        return self.return_loss(self.transition_cache.transition_cache)
 
-        pol_loss = 0
-        val_loss = 0
-        for transition in self.transition_cache.transition_cache:
-            G_t = transition.target_value
-            V_t = transition.expected_value
-            delta = G_t - V_t.item()
-
-            log_prob = transition.log_prob
-            #print("comput loss for step:", transition.readable_state, log_prob)
-            pol_loss += -log_prob * delta
-            G_t = torch.Tensor([G_t])
-            v_loss = torch.nn.L1Loss()(V_t, G_t)
-            val_loss += v_loss
+    def return_loss(self, transitions):
+        # stack the whole trial so the losses are computed in one pass rather than per step
+        log_probs = torch.stack([t.log_prob for t in transitions]).view(-1)
+        V_t = torch.stack([t.expected_value for t in transitions]).view(-1)
+        G_t = torch.as_tensor(np.asarray([t.target_value for t in transitions]), dtype=V_t.dtype, device=V_t.device)
+        delta = G_t - V_t.detach()
+
+        pol_loss = -(log_probs * delta).sum()
+        val_loss = F.l1_loss(V_t, G_t, reduction='sum')
         return pol_loss, val_loss
 
     def TD_loss(self):
@@ -124,20 +130,13 @@ class Agent(object):
     def discount_rwds(self):
         transitions = self.transition_cache.transition_cache
 
-        running_add = 0
-        returns = []
-        for t in reversed(range(len(transitions))):
-            running_add = running_add*self.gamma + transitions[t].reward
-            transitions[t] = transitions[t]._replace(target_value = running_add)
-            #returns.insert(0, running_add)
+        returns = discount_rwds(self.transition_cache.get_rewards(), gamma=self.gamma)
+        for t in range(len(transitions)):
+            transitions[t] = transitions[t]._replace(target_value = returns[t])
         # Scale rewards
         #returns = torch.FloatTensor(returns)
         #returns = (returns - returns.mean()) / (returns.std() + np.finfo(np.float32).eps)
 
-        # update transition cache with computed return values
-        #for i in range(len(transitions)):
-        #    transitions[i]._replace(target_value = returns[i])
-
         self.transition_cache.transition_cache = transitions
 
     def log_event(self, episode, event, state, action, reward, next_state, log_prob, expected_value, target_value, done, readable_state):
@@ -159,18 +158,70 @@ class Agent(object):
 
     def update(self):
         pol_loss, val_loss = self.calc_loss()
+        return self.apply_loss(pol_loss, val_loss)
 
+    def apply_loss(self, pol_loss, val_loss):
         self.optimizer.zero_grad()
         total_loss = pol_loss + val_loss
         total_loss.backward()
         self.optimizer.step()
 
-        return pol_loss, val_loss
+        # return plain floats so logged losses don't hold references to the trial's graph
+        return pol_loss.item(), val_loss.item()
+
+    def n_step_update(self, next_state_observation):
+        ## if update_every_n is set, call after each event that is not terminal
+        ## runs an update once n events have been logged since the last one
+        if len(self.transition_cache.transition_cache) - self.transition_cache.n_updated < self.update_every_n:
+            return
+
+        # value of the state after the last event, without advancing the recurrent state used for the next action
+        hx, cx = list(self.MFC.hx), list(self.MFC.cx)
+        with torch.no_grad():
+            _, bootstrap_value = self.MFC(next_state_observation)
+        self.MFC.hx, self.MFC.cx = hx, cx
+
+        p, v = self.partial_finish(bootstrap_value=bootstrap_value.item())
+        self.nstep_loss[0] += p
+        self.nstep_loss[1] += v
+
+    def partial_finish(self, bootstrap_value=0):
+        # update on the events logged since the last n-step update, using bootstrap_value for what follows them
+        # the cache resets n_updated when it is cleared, so this also holds for trials not ended by finish_
+        transitions = self.transition_cache.transition_cache
+        n_updated = self.transition_cache.n_updated
+        if n_updated == 0:
+            # first update of this trial; drop losses left over from a trial that was cleared without finish_
+            self.nstep_loss = [0.0, 0.0]
+        if len(transitions) == n_updated:
+            return 0.0, 0.0
+
+        rewards = self.transition_cache.get_rewards()[n_updated:]
+        returns = discount_rwds(np.append(rewards, bootstrap_value), gamma=self.gamma)[:-1]
+        for t, G_t in zip(range(n_updated, len(transitions)), returns):
+            transitions[t] = transitions[t]._replace(target_value = G_t)
+
+        p, v = self.apply_loss(*self.return_loss(transitions[n_updated:]))
+
+        # the weights these graphs were built from have changed, so keep only detached values (used by EC_storage)
+        for t in range(n_updated, len(transitions)):
+            transitions[t] = transitions[t]._replace(log_prob = transitions[t].log_prob.detach(),
+                                                     expected_value = transitions[t].expected_value.detach())
+        self.MFC.hx = [h if h is None else h.detach() for h in self.MFC.hx]
+        self.MFC.cx = [c if c is None else c.detach() for c in self.MFC.cx]
+        self.transition_cache.n_updated = len(transitions)
+        return p, v
 
     def finish_(self):
         ## if monte carlo, call at end of trial
         ## if TD, call at end of event
-        p, v = self.update()
+        ## if n-step, the events since the last update are discounted with no bootstrap value
+        if self.update_every_n is None:
+            p, v = self.update()
+        else:
+            p, v = self.partial_finish(bootstrap_value=0)
+            p, v = p + self.nstep_loss[0], v + self.nstep_loss[1]
+            self.nstep_loss = [0.0, 0.0]
         if self.EC != None:
             self.EC_storage()
 
@@ -198,20 +249,19 @@ class DualNetwork(Agent):
         else:
             self.calc_loss = self.MC_loss
 
+        self.update_every_n = None # n-step updates bootstrap from self.MFC, so only monte carlo updates here
+
 
     def MF_action(self, state_observation):
         policy = F.softmax(self.policy_net(state_observation))
         value = self.value_net(state_observation)
 
-        a = Categorical(policy)
-
-        action = a.sample()
+        action = torch.multinomial(policy, 1)
+        log_prob = torch.log(policy.gather(-1, action).clamp_min(1e-12)).squeeze()
 
-        return action.item(), a.log_prob(action), value.view(-1)
-
-    def update(self):
-        pol_loss, val_loss = self.calc_loss()
+        return action.item(), log_prob, value.view(-1)
 
+    def apply_loss(self, pol_loss, val_loss):
         self.policy_optimizer.zero_grad()
         self.value_optimizer.zero_grad()
         total_loss = pol_loss + val_loss
@@ -219,7 +269,7 @@ class DualNetwork(Agent):
         self.policy_optimizer.step()
         self.value_optimizer.step()
 
-        return pol_loss, val_loss
+        return pol_loss.item(), val_loss.item()
 
 class Agent_EC_stores_rewards(Agent):
     def __init__(self, network, memory):
@@ -20,6 +20,8 @@ class expt(object):
 		# self.rep_learner = rep_learner  #TODO add in later
 		self.data = self.reset_data_logs()
 		self.agent.counter = 0
+		# experiments with trials that must not change the weights turn this off for those trials
+		self.nstep_updates = True
 
 	def get_representation(self, state):
 		# TODO
@@ -150,6 +152,8 @@ class expt(object):
 							 done=done, readable_state=readable)
 		self.agent.counter += 1
 		self.state = next_state
+		if self.agent.update_every_n is not None and self.nstep_updates and not done:
+			self.agent.n_step_update(self.get_representation(next_state))
 		return done
 
 	def run(self, NUM_TRIALS, NUM_EVENTS, **kwargs):
@@ -178,6 +182,7 @@ class gridworldExperiment(expt):
 		# only for gridworld environment
 		self.sample_obs, self.sample_states = self.env.get_sample_obs()
 		self.sample_reps = self.get_reps()
+		self.sample_rows, self.sample_cols = np.array(self.sample_states).T
 
 		self.policy_grid = np.zeros(self.env.shape, dtype=[(x, 'f8') for x in self.env.action_list])
 		self.value_grid  = np.empty(self.env.shape)
@@ -203,6 +208,18 @@ class gridworldExperiment(expt):
 
 		return onehot_state
 
+	def batch_to_device(self, obs):
+		# stack observations and move them to the network's device in a single copy
+		states = torch.from_numpy(np.stack(obs)).float()
+		device = self.agent.MFC.device
+		if device.type == 'cuda':
+			states = states.pin_memory()
+		return states.to(device, non_blocking=True)
+
+	def grid_view(self, grid):
+		# policy grids have one f8 field per action, so they can be written as a (rows, cols, actions) float array
+		return grid.view(np.float64).reshape(grid.shape + (len(grid.dtype.names),))
+
 	def snapshot(self):
 		# initialize empty data frames
 		pol_grid = np.zeros(self.env.shape, dtype=[(x, 'f8') for x in self.env.action_list])
@@ -210,19 +227,18 @@ class gridworldExperiment(expt):
 
 		mem_grid = np.zeros(self.env.shape, dtype=[(x, 'f8') for x in self.env.action_list])
 
-		# forward pass through network
-		pols, vals = self.agent.MFC(self.sample_obs)
+		# forward pass through network; no graph is needed for the snapshot
+		with torch.no_grad(), self.agent.MFC.autocast():
+			pols, vals = self.agent.MFC(self.batch_to_device(self.sample_obs))
+		pols, vals = pols.float().cpu().numpy(), vals.float().cpu().numpy()
 
 		# populate with data from network
-		for s, p, v in zip(self.sample_states, pols, vals):
-			pol_grid[s] = tuple(p.data.numpy())
-			val_grid[s] = v.item()
+		rows, cols = self.sample_rows, self.sample_cols
+		self.grid_view(pol_grid)[rows, cols] = pols
+		val_grid[rows, cols] = vals.ravel()
 
 		if self.agent.EC is not None:
-			for ind, rep in enumerate(self.sample_reps):
-				mem_pol = self.agent.EC.recall_mem(tuple(rep))
-				state = self.sample_states[ind]
-				mem_grid[state] = tuple(mem_pol)
+			self.grid_view(mem_grid)[rows, cols] = self.agent.EC.recall_mem_batch(self.sample_reps)
 
 			return pol_grid, val_grid, mem_grid
 
@@ -239,14 +255,25 @@ class gridworldExperiment(expt):
 		MF_pols = self.policy_grid.copy()
 		MF_vals = self.value_grid.copy()
 
-		for rep, s in zip(reps, states2d):
-			p, v = self.agent.MFC(rep)
-			MF_vals[s[0], s[1]] = v
-			MF_pols[s[0], s[1]] = tuple(p)
+		# no graph is needed for the snapshot
+		recurrent = any(htype in ('lstm', 'gru') for htype in self.agent.MFC.hidden_types)
+		if recurrent:
+			# hidden states are sized for a single observation, so pass states through one at a time
+			for rep, s in zip(reps, states2d):
+				with torch.no_grad(), self.agent.MFC.autocast():
+					p, v = self.agent.MFC(rep)
+				MF_vals[s[0], s[1]] = v.item()
+				MF_pols[s[0], s[1]] = tuple(p.float().cpu().numpy())
+		else:
+			# one forward pass for all useable states
+			with torch.no_grad(), self.agent.MFC.autocast():
+				pols, vals = self.agent.MFC(self.batch_to_device(reps))
+			MF_vals[self.sample_rows, self.sample_cols] = vals.float().cpu().numpy().ravel()
+			self.grid_view(MF_pols)[self.sample_rows, self.sample_cols] = pols.float().cpu().numpy()
 
-			if self.agent.EC != None:
-				ec_p = self.agent.EC.recall_mem(tuple(rep), timestep=self.agent.counter)
-				EC_pols[s[0],s[1]] = tuple(ec_p)
+		if self.agent.EC != None:
+			ec_pols = self.agent.EC.recall_mem_batch(reps, timestep=self.agent.counter)
+			self.grid_view(EC_pols)[self.sample_rows, self.sample_cols] = ec_pols
 
 		self.data['V_snap'].append(MF_vals)
 		self.data['P_snap'].append(MF_pols)
@@ -279,6 +306,8 @@ class Bootstrap_viewMF(gridworldExperiment):
 		self.policy_grid = np.zeros(self.env.shape, dtype=[(x, 'f8') for x in self.env.action_list])
 		self.value_grid  = np.empty(self.env.shape)
 		self.data['weights'] = {'h0':[],'h1':[],'p':[],'v':[]} # h0, h1, p, v
+		# sets whose trials update the weights, so n-step updates (agent.update_every_n) only run in those
+		self.update_sets = [0]
 
 	def track_weights(self):
 		for y in range(len(self.agent.MFC.hidden)):
@@ -309,6 +338,7 @@ class Bootstrap_viewMF(gridworldExperiment):
 			data_key = 'bootstrap_reward'
 			# compute loss for MF guided trajectories, but don't use it to update weights
 			p, v = self.agent.calc_loss()
+			p, v = p.item(), v.item() # don't keep the trial's autograd graph alive in the data log
 			# use trajectories from MF guided trials in EC cache - try option without storing to EC
 			self.agent.EC_storage()                   # usually handled in self.agent.finish_()
 			self.agent.transition_cache.clear_cache() # usually handled in self.agent.finish_()
@@ -345,6 +375,7 @@ class Bootstrap_viewMF(gridworldExperiment):
 				self.state = self.env.reset()
 				self.reward_sum = 0
 
+				self.nstep_updates = set in self.update_sets
 				# set action picker
 				if set == 0:
 					self.agent.get_action = self.agent.EC_action
@@ -386,6 +417,7 @@ class Bootstrap_forgetfulMF(Bootstrap_viewMF):
 			data_key = 'bootstrap_reward'
 			# compute loss for MF guided trajectories, but don't use it to update weights
 			p, v = self.agent.calc_loss()
+			p, v = p.item(), v.item() # don't keep the trial's autograd graph alive in the data log
 			self.agent.transition_cache.clear_cache() # usually handled in self.agent.finish_()
 
 			self.data['mf_loss'][0].append(p)
@@ -409,6 +441,7 @@ class Bootstrap_forgetfulMF(Bootstrap_viewMF):
 class Bootstrap_interleaved(Bootstrap_viewMF):
 	def __init__(self, agent, environment):
 		super(Bootstrap_interleaved,self).__init__(agent, environment)
+		self.update_sets = [0, 1]
 
 	def end_of_trial(self, trial, set):
 		## regardless of action controller, use trajectory to update weights
@@ -444,6 +477,7 @@ class Bootstrap_verbose(Bootstrap_viewMF):
 	## same as Bootstrap_viewMF but do not record MF trials to EC
 	def __init__(self, agent, environment):
 		super(Bootstrap_verbose,self).__init__(agent, environment)
+		self.update_sets = [] # set 0 is updated with a full agent.update() at the end of the trial
 
 	def EC_storage(self):
 		mem_dict = {}
@@ -513,6 +547,7 @@ class Bootstrap_verbose(Bootstrap_viewMF):
 			data_key = 'bootstrap_reward'
 			# compute loss for MF guided trajectories, but don't use it to update weights
 			p, v = self.agent.calc_loss()
+			p, v = p.item(), v.item() # don't keep the trial's autograd graph alive in the data log
 			# use trajectories from MF guided trials in EC cache - try option without storing to EC
 			self.agent.EC_storage()                   # usually handled in self.agent.finish_()
 			self.agent.transition_cache.clear_cache() # usually handled in self.agent.finish_()
@@ -549,6 +584,7 @@ class Bootstrap_verbose(Bootstrap_viewMF):
 				self.state = self.env.reset()
 				self.reward_sum = 0
 
+				self.nstep_updates = set in self.update_sets
 				# set action picker
 				if set == 0:
 					self.agent.get_action = self.agent.EC_action
@@ -1,21 +1,42 @@
 import numpy as np
 import matplotlib.pyplot as plt
+try:
+	from scipy.signal import lfilter
+except ImportError:
+	lfilter = None
+try:
+	from numba import njit
+except ImportError:
+	njit = None
 
 def sigmoid(x):
     return 1 / (1 + math.exp(-x))
 
-def softmax(x, T=1):
-	e_x = np.exp((x - np.max(x))/T)
-	return np.round(e_x / e_x.sum(axis=0),8)
+def softmax(x, T=1, axis=0):
+	e_x = np.exp((x - np.max(x, axis=axis, keepdims=True))/T)
+	return np.round(e_x / e_x.sum(axis=axis, keepdims=True),8)
 
-def discount_rwds(r, gamma = 0.99):
-	disc_rwds = np.zeros_like(r)
-	running_add = 0
-	for t in reversed(range(0, r.size)):
+def _discount_loop(r, gamma):
+	disc_rwds = np.empty_like(r)
+	running_add = 0.0
+	for t in range(r.size - 1, -1, -1):
 		running_add = running_add*gamma + r[t]
 		disc_rwds[t] = running_add
 	return disc_rwds
 
+if njit is not None:
+	_discount_loop = njit(cache=True, fastmath=True)(_discount_loop)
+
+def discount_rwds(r, gamma = 0.99):
+	if lfilter is not None:
+		# G_t = r_t + gamma*G_{t+1} is a first order IIR filter run backwards in time
+		disc_rwds = lfilter([1.0], [1.0, -gamma], r[::-1])[::-1]
+	else:
+		# without scipy, fall back to the loop (compiled by numba if available)
+		# float64 input so the jitted loop only has to be compiled for one dtype
+		disc_rwds = _discount_loop(np.asarray(r, dtype=np.float64), float(gamma))
+	return disc_rwds.astype(r.dtype)
+
 def running_mean(x, N):
     cumsum = np.cumsum(np.insert(x, 0, 0))
     return (cumsum[N:] - cumsum[:-N]) / float(N)